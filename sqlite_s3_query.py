@@ -1,6 +1,8 @@
 import hmac
 import os
 import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from ctypes import CFUNCTYPE, POINTER, Structure, create_string_buffer, pointer, cast, memmove, memset, sizeof, addressof, cdll, byref, string_at, c_char_p, c_int, c_double, c_int64, c_void_p, c_char
 from ctypes.util import find_library
@@ -21,7 +23,9 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
     os.environ['AWS_ACCESS_KEY_ID'],
     os.environ['AWS_SECRET_ACCESS_KEY'],
     os.environ.get('AWS_SESSION_TOKEN'),  # Only needed for temporary credentials
-), get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3)),
+), get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3, limits=httpx.Limits(
+    max_keepalive_connections=32, max_connections=64, keepalive_expiry=90.0,
+))),
    get_libsqlite3=lambda: cdll.LoadLibrary(find_library('sqlite3'))):
     libsqlite3 = get_libsqlite3()
     libsqlite3.sqlite3_errstr.restype = c_char_p
@@ -31,36 +35,52 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
     libsqlite3.sqlite3_column_int64.restype = c_int64
     libsqlite3.sqlite3_column_blob.restype = c_void_p
     libsqlite3.sqlite3_column_bytes.restype = c_int64
+    libsqlite3.sqlite3_bind_int64.argtypes = (c_void_p, c_int, c_int64)
+    libsqlite3.sqlite3_bind_double.argtypes = (c_void_p, c_int, c_double)
     SQLITE_OK = 0
     SQLITE_IOERR = 10
     SQLITE_NOTFOUND = 12
     SQLITE_ROW = 100
     SQLITE_DONE = 101
     SQLITE_IOERR_SHORT_READ = 522
-    SQLITE_TRANSIENT = c_void_p(-1)
+    SQLITE_STATIC = c_void_p(0)
     SQLITE_OPEN_READONLY = 0x00000001
     SQLITE_OPEN_NOMUTEX = 0x00008000
     SQLITE_IOCAP_IMMUTABLE = 0x00002000
 
+    # Text and blobs are bound with SQLITE_STATIC so SQLite doesn't take its own copy of them. This
+    # is safe since bytes are immutable, and references to them are kept in refs until the
+    # statement is finalized
+    # ctypes silently truncates ints that don't fit in the argument type, so they are checked
+    def bind_int64(pp_stmt, i, value, _):
+        if not -9223372036854775808 <= value <= 9223372036854775807:
+            raise OverflowError('Python int too large to convert to SQLite INTEGER')
+        return libsqlite3.sqlite3_bind_int64(pp_stmt, i, value)
+
+    def bind_text(pp_stmt, i, value, refs):
+        encoded = value.encode('utf-8')
+        refs.append(encoded)
+        return libsqlite3.sqlite3_bind_text(pp_stmt, i, encoded, len(encoded), SQLITE_STATIC)
+
+    def bind_blob(pp_stmt, i, value, refs):
+        refs.append(value)
+        return libsqlite3.sqlite3_bind_blob(pp_stmt, i, value, len(value), SQLITE_STATIC)
+
     bind = {
-        type(0): libsqlite3.sqlite3_bind_int64,
-        type(0.0): libsqlite3.sqlite3_bind_double,
-        type(''): lambda pp_stmt, i, value: libsqlite3.sqlite3_bind_text(pp_stmt, i, value.encode('utf-8'), len(value.encode('utf-8')), SQLITE_TRANSIENT),
-        type(b''): lambda pp_stmt, i, value: libsqlite3.sqlite3_bind_blob(pp_stmt, i, value, len(value), SQLITE_TRANSIENT),
-        type(None): lambda pp_stmt, i, _: libsqlite3.sqlite3_bind_null(pp_stmt, i),
+        type(0): bind_int64,
+        type(0.0): lambda pp_stmt, i, value, _: libsqlite3.sqlite3_bind_double(pp_stmt, i, value),
+        type(''): bind_text,
+        type(b''): bind_blob,
+        type(None): lambda pp_stmt, i, _, __: libsqlite3.sqlite3_bind_null(pp_stmt, i),
     }
 
+    column_blob = libsqlite3.sqlite3_column_blob
+    column_bytes = libsqlite3.sqlite3_column_bytes
     extract = {
         1: libsqlite3.sqlite3_column_int64,
         2: libsqlite3.sqlite3_column_double,
-        3: lambda pp_stmt, i: string_at(
-            libsqlite3.sqlite3_column_blob(pp_stmt, i),
-            libsqlite3.sqlite3_column_bytes(pp_stmt, i),
-        ).decode(),
-        4: lambda pp_stmt, i: string_at(
-            libsqlite3.sqlite3_column_blob(pp_stmt, i),
-            libsqlite3.sqlite3_column_bytes(pp_stmt, i),
-        ),
+        3: lambda pp_stmt, i: string_at(column_blob(pp_stmt, i), column_bytes(pp_stmt, i)).decode(),
+        4: lambda pp_stmt, i: string_at(column_blob(pp_stmt, i), column_bytes(pp_stmt, i)),
         5: lambda pp_stmt, i: None,
     }
 
@@ -68,12 +88,28 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
 
     vfs_name = b's3-' + str(uuid4()).encode()
     file_name = b's3-' + str(uuid4()).encode()
-    body_hash = sha256(b'').hexdigest()
+    body_hash = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'  # sha256(b'').hexdigest()
     scheme, netloc, path, _, _ = urlsplit(url)
+    object_url = f'{scheme}://{netloc}{path}'
+    canonical_uri = quote(path, safe='/~')
+    host_header = ('host', netloc)
+    content_sha256_header = ('x-amz-content-sha256', body_hash)
 
     local = threading.local()
     local.pending_exception = None
 
+    # The signing key and credential scope only depend on the secret, the date and the region,
+    # so are cached between requests. Only the most recent are kept to not hold on to rotated
+    # credentials. There are also only a few shapes of request: the same method, query string and
+    # header names, so a template of the canonical request for each is made once, with
+    # placeholders for only the header values
+    signing_keys = {}
+    canonical_request_templates = {}
+
+    # hmac.digest, added in Python 3.7, calls directly into OpenSSL's one-shot HMAC without
+    # creating and updating a Python HMAC object
+    hmac_digest = getattr(hmac, 'digest', lambda key, msg, digest: hmac.new(key, msg, digest).digest())
+
     def get_request_headers_for_private_buckets(method, params, headers, now):
         region, access_key_id, secret_access_key, session_token = get_credentials(now)
         to_auth_headers = headers + (
@@ -112,51 +148,71 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
         if res != 0:
             raise SQLiteError(libsqlite3.sqlite3_errmsg(db).decode())
 
+    def get_auth_request_headers(method, params, headers):
+        return get_request_headers(method, params, headers, datetime.utcnow())
+
     @contextmanager
-    def make_auth_request(http_client, method, params, headers):
-        now = datetime.utcnow()
-        request_headers = get_request_headers(method, params, headers, now)
-        url = f'{scheme}://{netloc}{path}'
-        with http_client.stream(method, url, params=params, headers=request_headers) as response:
+    def make_request(http_client, method, params, request_headers):
+        with http_client.stream(method, object_url, params=params, headers=request_headers) as response:
             response.raise_for_status()
             yield response
 
+    @contextmanager
+    def make_auth_request(http_client, method, params, headers):
+        with make_request(http_client, method, params, get_auth_request_headers(method, params, headers)) as response:
+            yield response
+
     def aws_sigv4_headers(
         now, access_key_id, secret_access_key, region, method, headers_to_sign, params,
     ):
         def sign(key, msg):
-            return hmac.new(key, msg.encode('ascii'), sha256).digest()
+            return hmac_digest(key, msg.encode('ascii'), 'sha256')
 
         algorithm = 'AWS4-HMAC-SHA256'
 
-        amzdate = now.strftime('%Y%m%dT%H%M%SZ')
+        # Formatting the fields directly is about twice as fast as strftime
+        amzdate = '%04d%02d%02dT%02d%02d%02dZ' % (now.year, now.month, now.day, now.hour, now.minute, now.second)
         datestamp = amzdate[:8]
-        credential_scope = f'{datestamp}/{region}/s3/aws4_request'
+
+        signing_key_id = (secret_access_key, datestamp, region)
+        try:
+            credential_scope, request_key = signing_keys[signing_key_id]
+        except KeyError:
+            credential_scope = f'{datestamp}/{region}/s3/aws4_request'
+            date_key = sign(('AWS4' + secret_access_key).encode('ascii'), datestamp)
+            region_key = sign(date_key, region)
+            service_key = sign(region_key, 's3')
+            request_key = sign(service_key, 'aws4_request')
+            signing_keys[signing_key_id] = (credential_scope, request_key)
+            for stale_signing_key_id in tuple(signing_keys)[:-2]:
+                signing_keys.pop(stale_signing_key_id, None)
 
         headers = tuple(sorted(headers_to_sign + (
-            ('host', netloc),
-            ('x-amz-content-sha256', body_hash),
+            host_header,
+            content_sha256_header,
             ('x-amz-date', amzdate),
         )))
-        signed_headers = ';'.join(key for key, _ in headers)
+        request_shape = (method, params, tuple(key for key, _ in headers_to_sign))
+        try:
+            signed_headers, canonical_request_template = canonical_request_templates[request_shape]
+        except KeyError:
+            signed_headers = ';'.join(key for key, _ in headers)
+            quoted_params = sorted(
+                (quote(key, safe='~'), quote(value, safe='~'))
+                for key, value in params
+            )
+            canonical_querystring = '&'.join(f'{key}={value}' for key, value in quoted_params)
+            canonical_request_template = \
+                f'{method}\n{canonical_uri}\n{canonical_querystring}\n'.replace('%', '%%') + \
+                ''.join(f'{key}:%s\n' for key, _ in headers) + \
+                f'\n{signed_headers}\n{body_hash}'
+            canonical_request_templates[request_shape] = (signed_headers, canonical_request_template)
 
-        canonical_uri = quote(path, safe='/~')
-        quoted_params = sorted(
-            (quote(key, safe='~'), quote(value, safe='~'))
-            for key, value in params
-        )
-        canonical_querystring = '&'.join(f'{key}={value}' for key, value in quoted_params)
-        canonical_headers = ''.join(f'{key}:{value}\n' for key, value in headers)
-        canonical_request = f'{method}\n{canonical_uri}\n{canonical_querystring}\n' + \
-                            f'{canonical_headers}\n{signed_headers}\n{body_hash}'
+        canonical_request = canonical_request_template % tuple(value for _, value in headers)
 
         string_to_sign = f'{algorithm}\n{amzdate}\n{credential_scope}\n' + \
                          sha256(canonical_request.encode('ascii')).hexdigest()
 
-        date_key = sign(('AWS4' + secret_access_key).encode('ascii'), datestamp)
-        region_key = sign(date_key, region)
-        service_key = sign(region_key, 's3')
-        request_key = sign(service_key, 'aws4_request')
         signature = sign(request_key, string_to_sign).hex()
 
         return (
@@ -166,18 +222,48 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
             ),
         ) + headers
 
+    def read_body(response, amount):
+        chunks = []
+        length = 0
+
+        # Handle the case of the server being broken or slightly evil,
+        # returning more than the number of bytes that's asked for
+        for chunk in response.iter_bytes():
+            chunks.append(chunk)
+            length += len(chunk)
+            if length > amount:
+                break
+
+        # A single chunk, common for single pages, is returned by join without a copy
+        return b''.join(chunks)
+
     @contextmanager
     def get_vfs(http_client):
-        with make_auth_request(http_client, 'HEAD', (), ()) as response:
-            head_headers = response.headers
-            next(response.iter_bytes(), b'')
+        # Rather than a HEAD, the start of the file is requested, and its version and size are taken
+        # from the response, so the header and first pages of the database don't need requests of
+        # their own. An empty object has no range to return, so a HEAD is needed for it
+        start_size = 65536
+        try:
+            with make_auth_request(http_client, 'GET', (), (('range', f'bytes=0-{start_size - 1}'),)) as response:
+                start_headers = response.headers
+                start = read_body(response, start_size)
+        except httpx.HTTPStatusError as exception:
+            if exception.response.status_code != 416:
+                raise
+            with make_auth_request(http_client, 'HEAD', (), ()) as response:
+                start_headers = response.headers
+                next(response.iter_bytes(), b'')
+            start = b''
 
         try:
-            version_id = head_headers['x-amz-version-id']
+            version_id = start_headers['x-amz-version-id']
         except KeyError:
             raise VersioningNotEnabledError('The bucket must have versioning enabled')
 
-        size = int(head_headers['content-length'])
+        content_range = start_headers.get('content-range')
+        size = \
+            int(content_range.rsplit('/', 1)[1]) if content_range is not None else \
+            int(start_headers['content-length'])
 
         def make_struct(fields):
             class Struct(Structure):
@@ -187,43 +273,182 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
         x_open_type = CFUNCTYPE(c_int, c_void_p, c_char_p, c_void_p, c_int, POINTER(c_int))
         def x_open(p_vfs, z_name, p_file, flags, p_out_flags):
             memmove(p_file, addressof(file), sizeof(file))
+            read_states[p_file] = no_read_state
             p_out_flags[0] = flags
             return SQLITE_OK
 
         x_close_type = CFUNCTYPE(c_int, c_void_p)
         def x_close(p_file):
+            _, next_read_aheads, _, _ = read_states.pop(p_file, no_read_state)
+            for _, _, future in next_read_aheads:
+                future.cancel()
             return SQLITE_OK
 
+        # SQLite reads pages in increasing order when scanning a table, so once two reads in a row
+        # have each started where the previous one ended, the pages following are fetched in the
+        # same request and kept. A single adjacent read is common in lookups, so isn't enough.
+        # Once half of these have been read, the next ones are fetched in the background, in a window
+        # twice the size of the previous one up to a maximum, so long scans make fewer requests.
+        # A single request doesn't use all the bandwidth available, so a few consecutive windows are
+        # fetched concurrently
+        read_ahead_min_size = 131072
+        read_ahead_max_size = 8388608
+        read_ahead_windows = 4
+
+        # Each connection opens its own file, and so has its own read ahead and detection of
+        # sequential reads, so concurrent queries don't reset or replace each other's. The state is
+        # a tuple of the read ahead, the windows being fetched, where the previous read ended, and
+        # the number of sequential reads, keyed by the address of the file
+        no_read_state = ((0, b'', 0), (), None, 0)
+        read_states = {}
+
+        # Every connection, and so every query, starts by reading the header and the first page of
+        # the database that holds the root of the schema, so the largest read from the start of the
+        # file is kept for the life of the VFS. The version of the object is fixed, so it can't change
+        start_of_file = \
+            (0, start, cast(c_char_p(start), c_void_p).value) if len(start) <= min(start_size, size) else \
+            (0, b'', 0)
+
+        # Reads that aren't sequential fetch the whole aligned block around them: a request for a
+        # block costs about the same as one for a page, and pages near each other are often read
+        # together. Lookups descend through the same interior pages of indexes and tables each
+        # time, so the most recently used of these blocks are kept
+        block_size = 65536
+        blocks_max = 128
+        blocks = OrderedDict()
+        no_block = (0, b'', 0)
+
+        def get_block(block_ofst):
+            block = blocks.get(block_ofst, no_block)
+            if block is not no_block:
+                try:
+                    blocks.move_to_end(block_ofst)
+                except KeyError:
+                    # Evicted by another thread
+                    pass
+            return block
+
+        def put_block(block_ofst, block):
+            blocks[block_ofst] = block
+            while len(blocks) > blocks_max:
+                try:
+                    blocks.popitem(last=False)
+                except KeyError:
+                    break
+
+        # Every range requested has an end, and it's no further than the end of the object, so
+        # nothing more than is needed is transferred. A read that starts at or beyond the end is
+        # still requested, so the server's response to it is surfaced. Requests are signed
+        # separately from being made, so get_credentials is only ever called from the thread running
+        # the query, even for ranges fetched in the background
+        range_params = (('versionId', version_id),)
+
+        def sign_range(offset, amount):
+            last = offset + amount - 1 if offset >= size else min(offset + amount, size) - 1
+            return get_auth_request_headers('GET', range_params, (('range', f'bytes={offset}-{last}'),))
+
+        def fetch_range(request_headers, amount):
+            with make_request(http_client, 'GET', range_params, request_headers) as response:
+                return read_body(response, amount)
+
+        def get_range(offset, amount):
+            return fetch_range(sign_range(offset, amount), amount)
+
         x_read_type = CFUNCTYPE(c_int, c_void_p, c_void_p, c_int, c_int64)
         def x_read(p_file, p_out, i_amt, i_ofst):
-            offset = 0
+            nonlocal start_of_file
 
+            read_ahead, next_read_aheads, previous_read_end, sequential_reads = read_states[p_file]
             try:
-                with make_auth_request(http_client, 'GET',
-                    (('versionId', version_id),),
-                    (('range', f'bytes={i_ofst}-{i_ofst + i_amt - 1}'),)
-                ) as response:
-                    # Handle the case of the server being broken or slightly evil,
-                    # returning more than the number of bytes that's asked for
-                    for chunk in response.iter_bytes():
-                        memmove(p_out + offset, chunk, min(i_amt - offset, len(chunk)))
-                        offset += len(chunk)
-                        if offset > i_amt:
+                sequential_reads = sequential_reads + 1 if i_ofst == previous_read_end else 0
+                is_sequential = sequential_reads >= 2
+                previous_read_end = i_ofst + i_amt
+
+                # The address of the data is kept so reads from the read ahead, the most common case, are
+                # a comparison and a single memmove rather than creating any ctypes objects. The block
+                # cache is only looked up, and its order updated, if neither of these has the data
+                for data_ofst, data, data_address in (read_ahead, start_of_file):
+                    if data_ofst <= i_ofst and i_ofst + i_amt <= data_ofst + len(data):
+                        break
+                else:
+                    data_ofst, data, data_address = get_block(i_ofst - i_ofst % block_size)
+                    if not (data_ofst <= i_ofst and i_ofst + i_amt <= data_ofst + len(data)):
+                        if is_sequential:
+                            data_ofst = i_ofst
+                            amount = max(i_amt, min(read_ahead_min_size, size - i_ofst))
+                        else:
+                            data_ofst = i_ofst - i_ofst % block_size
+                            amount = -(-(i_ofst + i_amt) // block_size) * block_size - data_ofst
+
+                        for next_ofst, next_amount, future in next_read_aheads if is_sequential else ():
+                            if next_ofst == data_ofst:
+                                amount = next_amount
+                                next_read_aheads = tuple(
+                                    next_read_ahead for next_read_ahead in next_read_aheads
+                                    if next_read_ahead[0] > data_ofst
+                                )
+                                break
+                        else:
+                            future = None
+
+                        try:
+                            if future is not None:
+                                data = future.result()
+                            else:
+                                data = get_range(data_ofst, amount)
+                        except Exception as exception:
+                            set_pending_exception(exception)
+                            return SQLITE_IOERR
+
+                        if len(data) > min(amount, max(size - data_ofst, 0)):
+                            return SQLITE_IOERR
+
+                        data_address = cast(c_char_p(data), c_void_p).value
+                        if is_sequential:
+                            read_ahead = (data_ofst, data, data_address)
+                        elif data_ofst == 0 and len(data) > len(start_of_file[1]):
+                            start_of_file = (data_ofst, data, data_address)
+                        else:
+                            put_block(data_ofst, (data_ofst, data, data_address))
+
+                if is_sequential and (i_ofst + i_amt - data_ofst) * 2 >= len(data) and \
+                        len(next_read_aheads) < read_ahead_windows:
+                    # The windows must follow on from the data being read, otherwise the scan has moved
+                    # on and they are no longer needed
+                    if next_read_aheads and next_read_aheads[0][0] == data_ofst + len(data):
+                        pending = next_read_aheads
+                    else:
+                        for _, _, future in next_read_aheads:
+                            future.cancel()
+                        pending = ()
+                    last_ofst, last_amount = pending[-1][:2] if pending else (data_ofst, len(data))
+                    while len(pending) < read_ahead_windows:
+                        next_ofst = last_ofst + last_amount
+                        next_amount = min(max(read_ahead_min_size, last_amount * 2), read_ahead_max_size, size - next_ofst)
+                        if next_amount <= 0:
                             break
-            except Exception as exception:
-                set_pending_exception(exception)
-                return SQLITE_IOERR
+                        try:
+                            request_headers = sign_range(next_ofst, next_amount)
+                        except Exception:
+                            # Reading ahead is only an optimisation: the range is requested again
+                            # when it's read, which surfaces the error
+                            break
+                        pending += ((next_ofst, next_amount, executor.submit(fetch_range, request_headers, next_amount)),)
+                        last_ofst, last_amount = next_ofst, next_amount
+                    next_read_aheads = pending
 
-            if offset < i_amt:
-                # The SQLite docs strongly suggest to fill unused with zeroes
-                remainder = i_amt - offset
-                memmove(p_out + offset, b'\0' * remainder, remainder)
-                return SQLITE_IOERR_SHORT_READ
+                offset = i_ofst - data_ofst
+                length = min(i_amt, len(data) - offset)
+                memmove(p_out, data_address + offset, length)
 
-            if offset > i_amt:
-                return SQLITE_IOERR
+                if length < i_amt:
+                    # The SQLite docs strongly suggest to fill unused with zeroes
+                    memset(p_out + length, 0, i_amt - length)
+                    return SQLITE_IOERR_SHORT_READ
 
-            return SQLITE_OK
+                return SQLITE_OK
+            finally:
+                read_states[p_file] = (read_ahead, next_read_aheads, previous_read_end, sequential_reads)
 
         x_file_size_type = CFUNCTYPE(c_int, c_void_p, POINTER(c_int64))
         def x_file_size(p_file, p_size):
@@ -251,9 +476,14 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
             z_out[0] = 0
             return SQLITE_OK
 
-        x_full_pathname_type = CFUNCTYPE(c_int, c_void_p, c_char_p, c_int, POINTER(c_char))
+        # The only file opened with the VFS is file_name, so its full path name, including the
+        # terminating null, is known in advance
+        full_pathname = file_name + b'\0'
+        full_pathname_length = len(full_pathname)
+
+        x_full_pathname_type = CFUNCTYPE(c_int, c_void_p, c_void_p, c_int, POINTER(c_char))
         def x_full_pathname(p_vfs, z_name, n_out, z_out):
-            memmove(z_out, z_name, len(z_name) + 1)
+            memmove(z_out, full_pathname, full_pathname_length)
             return SQLITE_OK
 
         x_current_time_type = CFUNCTYPE(c_int, c_void_p, POINTER(c_double))
@@ -300,11 +530,18 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
             ('x_get_last_error', c_void_p, None),
         ))
 
-        run(libsqlite3.sqlite3_vfs_register, byref(vfs), 0)
+        # Windows not yet started are cancelled when their file is closed. Those already being
+        # fetched aren't waited for on exit, since nothing will read them, and any errors from them
+        # are not raised
+        executor = ThreadPoolExecutor(max_workers=read_ahead_windows)
         try:
-            yield vfs
+            run(libsqlite3.sqlite3_vfs_register, byref(vfs), 0)
+            try:
+                yield vfs
+            finally:
+                run(libsqlite3.sqlite3_vfs_unregister, byref(vfs))
         finally:
-            run(libsqlite3.sqlite3_vfs_unregister, byref(vfs))
+            executor.shutdown(wait=False)
 
     @contextmanager
     def get_db(vfs):
@@ -356,19 +593,25 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
         yield get_pp_stmts
 
     def rows(get_pp_stmt, columns):
+        # Called for every cell, so everything is looked up once up front
+        step = libsqlite3.sqlite3_step
+        column_type = libsqlite3.sqlite3_column_type
+        extract_by_type = extract
+        column_indexes = range(0, len(columns))
+
         while True:
             pp_stmt = get_pp_stmt()
-            res = libsqlite3.sqlite3_step(pp_stmt)
+            res = step(pp_stmt)
             if res == SQLITE_DONE:
                 break
             if res != SQLITE_ROW:
                 raise_any_pending_exception()
                 raise SQLiteError(libsqlite3.sqlite3_errstr(res).decode())
 
-            yield tuple(
-                extract[libsqlite3.sqlite3_column_type(pp_stmt, i)](pp_stmt, i)
-                for i in range(0, len(columns))
-            )
+            yield tuple([
+                extract_by_type[column_type(pp_stmt, i)](pp_stmt, i)
+                for i in column_indexes
+            ])
 
     def query(vfs, sql, params=(), named_params=()):
 
@@ -382,14 +625,15 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
                 get_pp_stmt_getter(db) as get_pp_stmts:
 
             for (get_pp_stmt, finalize_stmt), statment_params, statement_named_params in zip_first(get_pp_stmts(sql), params, named_params):
+                refs = []
                 try:
                     pp_stmt = get_pp_stmt()
                     for i, param in enumerate(statment_params):
-                        run_with_db(db, bind[type(param)], pp_stmt, i + 1, param)
+                        run_with_db(db, bind[type(param)], pp_stmt, i + 1, param, refs)
 
                     for param_name, param_value in statement_named_params:
                         index = libsqlite3.sqlite3_bind_parameter_index(pp_stmt, param_name.encode('utf-8'))
-                        run_with_db(db, bind[type(param_value)], pp_stmt, index, param_value)
+                        run_with_db(db, bind[type(param_value)], pp_stmt, index, param_value, refs)
 
                     columns = tuple(
                         libsqlite3.sqlite3_column_name(pp_stmt, i).decode()
@@ -399,6 +643,7 @@ def sqlite_s3_query_multi(url, get_credentials=lambda now: (
                     yield columns, rows(get_pp_stmt, columns)
                 finally:
                     finalize_stmt()
+                    refs.clear()
 
     with \
             get_http_client() as http_client, \
@@ -413,7 +658,9 @@ def sqlite_s3_query(url, get_credentials=lambda now: (
     os.environ['AWS_ACCESS_KEY_ID'],
     os.environ['AWS_SECRET_ACCESS_KEY'],
     os.environ.get('AWS_SESSION_TOKEN'),  # Only needed for temporary credentials
-), get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3)),
+), get_http_client=lambda: httpx.Client(transport=httpx.HTTPTransport(retries=3, limits=httpx.Limits(
+    max_keepalive_connections=32, max_connections=64, keepalive_expiry=90.0,
+))),
    get_libsqlite3=lambda: cdll.LoadLibrary(find_library('sqlite3'))):
 
     @contextmanager